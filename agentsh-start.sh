@@ -0,0 +1,13 @@
+#!/bin/sh
+# Sandbox start command: start the agentsh daemon in the background unless one
+# is already listening, then run the given command in the foreground (or idle
+# if there is none).
+
+if ! curl -sf -o /dev/null --max-time 1 http://127.0.0.1:18080/health; then
+    agentsh server --config /etc/agentsh/config.yaml >> /var/log/agentsh/agentsh.log 2>&1 &
+fi
+
+if [ "$#" -eq 0 ]; then
+    set -- sleep infinity
+fi
+exec "$@"
@@ -0,0 +1,315 @@
+"""
+Helpers shared by detect.py, example.py and tests.py.
+
+Covers the agentsh Modal image, warm sandbox reuse and a persistent shell for
+running many short commands in a sandbox. The scripts only use local
+entrypoints and sandboxes, so this module is never imported inside Modal.
+"""
+
+import modal
+import hashlib
+import os
+import queue
+import re
+import threading
+import time
+import urllib.request
+import uuid
+from pathlib import Path
+from modal.stream_type import StreamType
+
+# =============================================================================
+# CONFIGURATION
+# =============================================================================
+
+AGENTSH_REPO = "canyonroad/agentsh"
+AGENTSH_TAG = "v0.8.10"
+DEB_ARCH = "amd64"
+# SHA-256 of the release .deb, checked by local builds (and by the Dockerfile via
+# its build arg of the same name). When empty, the digest is read from the
+# release's checksums asset instead; a mismatch fails the build either way.
+AGENTSH_DEB_SHA256 = ""
+DEB_CACHE_DIR = Path.home() / ".cache" / "agentsh"
+# Prebuilt image published from the Dockerfile by CI; set AGENTSH_LOCAL_BUILD=1
+# to build the image locally instead
+AGENTSH_IMAGE = f"ghcr.io/canyonroad/agentsh-modal:{AGENTSH_TAG}"
+LOCAL_BUILD = os.environ.get("AGENTSH_LOCAL_BUILD") == "1"
+
+# Set AGENTSH_WARM_SANDBOX=1 to keep the sandbox running after main() and
+# reuse it on the next run instead of cold-starting a new one. A warm sandbox
+# is dropped after 15 idle minutes, and after an hour regardless.
+WARM_SANDBOX = os.environ.get("AGENTSH_WARM_SANDBOX") == "1"
+WARM_IDLE_TIMEOUT = 60 * 15
+WARM_TIMEOUT = 60 * 60
+
+REPO_DIR = Path(__file__).parent
+# agentsh config files in this repo, and where they go in the image
+AGENTSH_CONFIG_FILES = {
+    "config.yaml": "/etc/agentsh/config.yaml",
+    "default.yaml": "/etc/agentsh/policies/default.yaml",
+}
+
+
+# =============================================================================
+# MODAL IMAGE DEFINITION
+# =============================================================================
+
+def _sha256(path: Path) -> str:
+    """Return the hex SHA-256 digest of a local file."""
+    digest = hashlib.sha256()
+    with path.open("rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def _expected_deb_sha256(version: str, deb_name: str) -> str:
+    """Return the SHA-256 the .deb must match.
+
+    Uses AGENTSH_DEB_SHA256 if pinned, else the release's checksums asset,
+    which is cached next to the .deb so rebuilds check against the same value.
+    """
+    if AGENTSH_DEB_SHA256:
+        return AGENTSH_DEB_SHA256
+
+    checksums_name = f"agentsh_{version}_checksums.txt"
+    checksums_path = DEB_CACHE_DIR / checksums_name
+    if not checksums_path.exists():
+        DEB_CACHE_DIR.mkdir(parents=True, exist_ok=True)
+        part_path = checksums_path.with_suffix(".part")
+        urllib.request.urlretrieve(
+            f"https://github.com/{AGENTSH_REPO}/releases/download/v{version}/{checksums_name}", part_path
+        )
+        part_path.replace(checksums_path)
+
+    for line in checksums_path.read_text().splitlines():
+        fields = line.split()
+        if len(fields) == 2 and fields[1].lstrip("*") == deb_name:
+            return fields[0]
+    raise RuntimeError(f"{deb_name} is not listed in {checksums_path}")
+
+
+def _fetch_deb_cached(version: str) -> Path:
+    """Download the agentsh .deb once into DEB_CACHE_DIR and return its path.
+
+    The cached file is reused only while it matches the expected SHA-256;
+    otherwise it is downloaded again, and a download that doesn't match
+    raises RuntimeError.
+    """
+    deb_name = f"agentsh_{version}_linux_{DEB_ARCH}.deb"
+    deb_url = f"https://github.com/{AGENTSH_REPO}/releases/download/v{version}/{deb_name}"
+    deb_path = DEB_CACHE_DIR / deb_name
+    expected = _expected_deb_sha256(version, deb_name)
+
+    if deb_path.exists() and _sha256(deb_path) == expected:
+        return deb_path
+
+    DEB_CACHE_DIR.mkdir(parents=True, exist_ok=True)
+    part_path = deb_path.with_suffix(".part")
+    urllib.request.urlretrieve(deb_url, part_path)
+    if _sha256(part_path) != expected:
+        part_path.unlink()
+        raise RuntimeError(f"Checksum mismatch for {deb_name} (expected {expected})")
+    part_path.replace(deb_path)
+    return deb_path
+
+
+def build_agentsh_image() -> modal.Image:
+    """Build a Modal image with agentsh installed (mirrors the Dockerfile)."""
+    deb_path = _fetch_deb_cached(AGENTSH_TAG.lstrip("v"))
+    # Install packages and drop the apt lists in the same step, so they never
+    # end up in an image layer
+    apt_cmd = " && ".join([
+        "apt-get update",
+        "apt-get install -y --no-install-recommends " + " ".join([
+            "ca-certificates",
+            "curl",
+            "bash",
+            "git",
+            "sudo",
+            "libseccomp2",
+            "netcat-openbsd",
+            "openssh-client",
+        ]),
+        "rm -rf /var/lib/apt/lists/* /var/cache/apt/archives/*",
+    ])
+    # Run the whole install as one shell step so it produces a single image
+    # layer; the version-specific dpkg step goes last.
+    install_cmd = " && ".join([
+        "mkdir -p /etc/agentsh/policies /var/lib/agentsh/quarantine /var/lib/agentsh/sessions /var/log/agentsh",
+        "chmod 777 /etc/agentsh /etc/agentsh/policies",
+        "chmod 777 /var/lib/agentsh /var/lib/agentsh/quarantine /var/lib/agentsh/sessions",
+        "chmod 777 /var/log/agentsh",
+        "dpkg -i /tmp/agentsh.deb",
+        "rm -f /tmp/agentsh.deb",
+        "agentsh --version",
+    ])
+
+    return (
+        modal.Image.debian_slim(python_version="3.11")
+        .run_commands(apt_cmd)
+        .add_local_file(deb_path, "/tmp/agentsh.deb", copy=True)
+        .run_commands(install_cmd)
+        .env({"AGENTSH_SERVER": "http://127.0.0.1:18080"})
+    )
+
+
+def create_agentsh_image(local_files: dict[str, str] | None = None) -> modal.Image:
+    """Create a Modal image with agentsh installed.
+
+    Args:
+        local_files: Files from this repo to ship with the image, mapped to
+                     their path in the sandbox (e.g. AGENTSH_CONFIG_FILES).
+    """
+    if LOCAL_BUILD:
+        image = build_agentsh_image()
+    else:
+        image = modal.Image.from_registry(AGENTSH_IMAGE, add_python="3.11")
+
+    # Ship config and scripts with the image instead of writing them per sandbox
+    for name, remote_path in (local_files or {}).items():
+        image = image.add_local_file(REPO_DIR / name, remote_path)
+    return image
+
+
+# =============================================================================
+# SANDBOX HELPERS
+# =============================================================================
+
+def warm_sandbox_name(prefix: str, local_files: dict[str, str] | None = None) -> str:
+    """Name a warm sandbox after the agentsh image and the repo files it ships.
+
+    Files added with add_local_file are fixed when the sandbox boots, so
+    keying the name to their contents makes edits start a fresh sandbox
+    instead of silently reusing one with the old files.
+    """
+    digest = hashlib.sha256(AGENTSH_IMAGE.encode())
+    for name in sorted(local_files or {}):
+        digest.update(name.encode() + b"\0" + (REPO_DIR / name).read_bytes())
+    return f"{prefix}-{digest.hexdigest()[:12]}"
+
+
+def claim_sandbox(
+    app: modal.App, image: modal.Image, warm_app_name: str, warm_sandbox_name: str, timeout: int
+) -> modal.Sandbox:
+    """Return a sandbox for this run, reusing the warm one if enabled and running.
+
+    `timeout` applies to a fresh sandbox; warm ones live for WARM_TIMEOUT.
+    """
+    if not WARM_SANDBOX:
+        return modal.Sandbox.create(app=app, image=image, timeout=timeout)
+
+    try:
+        return modal.Sandbox.from_name(warm_app_name, warm_sandbox_name)
+    except modal.exception.NotFoundError:
+        # Named sandboxes must belong to a deployed app to be found again later
+        warm_app = modal.App.lookup(warm_app_name, create_if_missing=True)
+        return modal.Sandbox.create(
+            app=warm_app,
+            image=image,
+            name=warm_sandbox_name,
+            timeout=WARM_TIMEOUT,
+            idle_timeout=WARM_IDLE_TIMEOUT,
+        )
+
+
+def kill_process_groups(sb: modal.Sandbox, pgids: list[int]) -> None:
+    """SIGKILL every process in the given process groups, in one sandbox exec."""
+    if pgids:
+        sb.exec("bash", "-c", " ".join(f"kill -KILL -- -{pgid} 2>/dev/null;" for pgid in pgids)).wait()
+
+
+class PersistentShell:
+    """A long-lived `bash -s` process in the sandbox that runs commands one at a time.
+
+    Commands are written to the shell's stdin and their combined stdout/stderr
+    is read back up to a sentinel line carrying the exit code, so each command
+    costs a pipe round-trip instead of a new exec and bash startup.
+
+    The shell runs in its own process group (`pgid`), so a hung command and
+    anything it started can be killed along with it.
+    """
+
+    def __init__(self, sb: modal.Sandbox):
+        self._sb = sb
+        self._start()
+
+    def _start(self) -> None:
+        self._process = self._sb.exec("setsid", "-w", "bash", "-s", stderr=StreamType.DEVNULL)
+        self._chunks: queue.SimpleQueue[str | None] = queue.SimpleQueue()
+        self._buffer = ""
+        threading.Thread(target=self._pump, args=(self._process, self._chunks), daemon=True).start()
+
+        # The shell leads its new session, so its PID is also its process group
+        self._process.stdin.write("echo $$\n")
+        self._process.stdin.drain()
+        deadline = time.monotonic() + 30
+        while "\n" not in self._buffer:
+            try:
+                chunk = self._chunks.get(timeout=max(deadline - time.monotonic(), 0))
+            except queue.Empty:
+                chunk = None
+            if chunk is None:
+                raise RuntimeError("sandbox shell did not start")
+            self._buffer += chunk
+        pgid, self._buffer = self._buffer.split("\n", 1)
+        self.pgid = int(pgid)
+
+    @staticmethod
+    def _pump(process, chunks: queue.SimpleQueue) -> None:
+        for chunk in process.stdout:
+            chunks.put(chunk)
+        chunks.put(None)
+
+    def _restart(self) -> None:
+        """Replace the shell with a fresh one, killing the old one first."""
+        self.close()
+        self._start()
+
+    def close(self) -> None:
+        """Kill the shell and anything still running in its process group."""
+        kill_process_groups(self._sb, [self.pgid])
+
+    def run(self, command: str, timeout: float = 30, max_output: int | None = None) -> tuple[str, int]:
+        """Run a command and return (output, exit_code).
+
+        Only the first max_output characters of output are kept and returned;
+        the rest is discarded as it arrives. Raises TimeoutError if the command
+        doesn't finish within `timeout` seconds, or RuntimeError if the shell
+        exits; either way the shell is replaced with a fresh one and can be
+        reused.
+        """
+        marker = uuid.uuid4().hex
+        done_re = re.compile(rf"===END:{marker}:(\d+)===\n")
+        # Longer than any sentinel line, so a sentinel split across chunks is
+        # always found within the rolling tail
+        tail_len = len(marker) + 16
+        # stdin is /dev/null so commands can't consume the lines that follow
+        self._process.stdin.write(f"{{ {command}\n}} < /dev/null 2>&1\nprintf '===END:{marker}:%s===\\n' $?\n")
+        self._process.stdin.drain()
+
+        # `tail` is the not-yet-searched end of the stream; text that can no
+        # longer be part of the sentinel moves from it into `output`
+        output = ""
+        tail, self._buffer = self._buffer, ""
+        deadline = time.monotonic() + timeout
+        while (match := done_re.search(tail)) is None:
+            try:
+                chunk = self._chunks.get(timeout=max(deadline - time.monotonic(), 0))
+            except queue.Empty:
+                self._restart()
+                raise TimeoutError(f"command did not finish within {timeout}s") from None
+            if chunk is None:
+                self._restart()
+                raise RuntimeError("sandbox shell exited")
+            tail += chunk
+            if len(tail) > tail_len:
+                output = self._keep_head(output + tail[:-tail_len], max_output)
+                tail = tail[-tail_len:]
+
+        self._buffer = tail[match.end():]
+        return self._keep_head(output + tail[:match.start()], max_output), int(match.group(1))
+
+    @staticmethod
+    def _keep_head(text: str, limit: int | None) -> str:
+        return text if limit is None else text[:limit]
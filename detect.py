@@ -4,81 +4,77 @@ Run agentsh detect inside a Modal sandbox to discover capabilities.
 """
 
 import modal
-
-AGENTSH_REPO = "canyonroad/agentsh"
-AGENTSH_TAG = "v0.8.10"
-DEB_ARCH = "amd64"
-
-
-def create_agentsh_image() -> modal.Image:
-    """Create a Modal image with agentsh installed."""
-    version = AGENTSH_TAG.lstrip("v")
-    deb_name = f"agentsh_{version}_linux_{DEB_ARCH}.deb"
-    deb_url = f"https://github.com/{AGENTSH_REPO}/releases/download/{AGENTSH_TAG}/{deb_name}"
-
-    return (
-        modal.Image.debian_slim(python_version="3.11")
-        .apt_install(
-            "ca-certificates",
-            "curl",
-            "bash",
-            "git",
-            "sudo",
-            "libseccomp2",
-        )
-        .run_commands(
-            f"curl -fsSL -L '{deb_url}' -o /tmp/agentsh.deb",
-            "dpkg -i /tmp/agentsh.deb",
-            "rm -f /tmp/agentsh.deb",
-            "agentsh --version",
-        )
-    )
-
+import re
+from agentsh_common import WARM_SANDBOX, claim_sandbox, create_agentsh_image, warm_sandbox_name
+
+# Names of the sandbox reused when AGENTSH_WARM_SANDBOX=1
+WARM_APP_NAME = "agentsh-detect-warm"
+WARM_SANDBOX_NAME = warm_sandbox_name("agentsh-detect")
+
+# (title, command) pairs run by main() in a single sandbox exec
+DETECT_SECTIONS = (
+    ("agentsh version", "agentsh --version"),
+    ("agentsh detect", "agentsh detect"),
+    ("agentsh detect config", "agentsh detect config"),
+)
+# Each section starts with a marker on both stdout and stderr. The marker isn't
+# anchored to a line start, since the previous section may not end in a newline.
+DETECT_SCRIPT = "\n".join(
+    f"echo '===AGENTSH_SECTION:{i}==='; echo '===AGENTSH_SECTION:{i}===' >&2; {command}"
+    for i, (_, command) in enumerate(DETECT_SECTIONS)
+)
+_SECTION_MARKER_RE = re.compile(r"===AGENTSH_SECTION:(\d+)===\n")
 
 app = modal.App("agentsh-detect")
 image = create_agentsh_image()
 
 
+def _split_sections(output: str) -> list[str]:
+    """Split DETECT_SCRIPT output into one string per section.
+
+    Sections whose marker is missing come back empty, so the result always
+    lines up with DETECT_SECTIONS.
+    """
+    sections = [""] * len(DETECT_SECTIONS)
+    pieces = _SECTION_MARKER_RE.split(output)
+    for index, text in zip(pieces[1::2], pieces[2::2]):
+        sections[int(index)] = text
+    return sections
+
+
+def _drain(p) -> tuple[str, str]:
+    """Read a finished process's stdout and stderr exactly once each."""
+    return p.stdout.read(), p.stderr.read()
+
+
 @app.local_entrypoint()
 def main():
     print("=" * 70)
     print("  Running agentsh detect inside Modal sandbox")
     print("=" * 70)
 
-    sb = modal.Sandbox.create(
-        app=app,
-        image=image,
-        timeout=60 * 5,
-    )
+    sb = claim_sandbox(app, image, WARM_APP_NAME, WARM_SANDBOX_NAME, timeout=60 * 5)
 
     try:
-        print(f"\nSandbox ID: {sb.object_id}\n")
+        print(f"\nSandbox ID: {sb.object_id}")
 
-        # Run agentsh version
-        print("=== agentsh version ===")
-        p = sb.exec("agentsh", "--version")
+        # Run all agentsh commands in one exec, then split the output per section
+        p = sb.exec("bash", "-c", DETECT_SCRIPT)
         p.wait()
-        print(p.stdout.read())
+        stdout, stderr = _drain(p)
 
-        # Run agentsh detect
-        print("\n=== agentsh detect ===")
-        p = sb.exec("agentsh", "detect")
-        p.wait()
-        print(p.stdout.read())
-        if p.stderr.read():
-            print("stderr:", p.stderr.read())
-
-        # Run agentsh detect config
-        print("\n=== agentsh detect config ===")
-        p = sb.exec("agentsh", "detect", "config")
-        p.wait()
-        print(p.stdout.read())
-        if p.stderr.read():
-            print("stderr:", p.stderr.read())
+        for (title, _), out, err in zip(DETECT_SECTIONS, _split_sections(stdout), _split_sections(stderr)):
+            print(f"\n=== {title} ===")
+            print(out)
+            if err:
+                print("stderr:", err)
 
     finally:
-        print("\nTerminating sandbox...")
-        sb.terminate()
+        if WARM_SANDBOX:
+            print("\nLeaving sandbox running for the next run.")
+        else:
+            print("\nTerminating sandbox...")
+            sb.terminate()
         print("Done.")
 
 
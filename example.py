@@ -15,15 +15,35 @@ Usage:
 """
 
 import modal
-from pathlib import Path
+import queue
+import re
+import threading
+import time
+from collections.abc import Callable
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
+from agentsh_common import (
+    AGENTSH_CONFIG_FILES,
+    WARM_SANDBOX,
+    PersistentShell,
+    claim_sandbox,
+    create_agentsh_image,
+    kill_process_groups,
+    warm_sandbox_name,
+)
 
 # =============================================================================
 # AGENTSH CONFIGURATION
 # =============================================================================
 
-AGENTSH_REPO = "canyonroad/agentsh"
-AGENTSH_TAG = "v0.8.10"
-DEB_ARCH = "amd64"
+# Names of the sandbox reused when AGENTSH_WARM_SANDBOX=1
+WARM_APP_NAME = "agentsh-sandbox-warm"
+WARM_SANDBOX_NAME = warm_sandbox_name("agentsh-sandbox", AGENTSH_CONFIG_FILES)
+
+# Maximum number of tests run concurrently within a category
+MAX_PARALLEL_TESTS = 8
+# Characters of test output kept for display
+OUTPUT_LIMIT = 200
 
 # =============================================================================
 # SECURITY TEST DEFINITIONS
@@ -284,41 +304,66 @@ SECURITY_TESTS = {
     },
 }
 
+# Output that marks a "blocked" test as passed even when the command exits 0
+_BLOCKED_OUTPUT_RE = re.compile(r"blocked|denied|permission|not found|400", re.IGNORECASE)
 
-# =============================================================================
-# MODAL IMAGE DEFINITION
-# =============================================================================
 
-def create_agentsh_image() -> modal.Image:
-    """Create a Modal image with agentsh installed."""
-    version = AGENTSH_TAG.lstrip("v")
-    deb_name = f"agentsh_{version}_linux_{DEB_ARCH}.deb"
-    deb_url = f"https://github.com/{AGENTSH_REPO}/releases/download/{AGENTSH_TAG}/{deb_name}"
-
-    return (
-        modal.Image.debian_slim(python_version="3.11")
-        .apt_install(
-            "ca-certificates",
-            "curl",
-            "bash",
-            "git",
-            "sudo",
-            "libseccomp2",
-        )
-        .run_commands(
-            # Download and install agentsh
-            f"curl -fsSL -L '{deb_url}' -o /tmp/agentsh.deb",
-            "dpkg -i /tmp/agentsh.deb",
-            "rm -f /tmp/agentsh.deb",
-            "agentsh --version",
-            # Create agentsh directories
-            "mkdir -p /etc/agentsh/policies /var/lib/agentsh/quarantine /var/lib/agentsh/sessions /var/log/agentsh",
-            "chmod 777 /etc/agentsh /etc/agentsh/policies",
-            "chmod 777 /var/lib/agentsh /var/lib/agentsh/quarantine /var/lib/agentsh/sessions",
-            "chmod 777 /var/log/agentsh",
-        )
-        .env({"AGENTSH_SERVER": "http://127.0.0.1:18080"})
+def _passes_if_blocked(output: str, exit_code: int) -> bool:
+    """For blocked tests, we expect non-zero exit or error message."""
+    return exit_code != 0 or _BLOCKED_OUTPUT_RE.search(output) is not None
+
+
+def _passes_if_success(output: str, exit_code: int) -> bool:
+    return exit_code == 0
+
+
+def _always_passes(output: str, exit_code: int) -> bool:
+    return True
+
+
+_EXPECT_PREDICATES = {
+    "blocked": _passes_if_blocked,
+    "success": _passes_if_success,
+}
+
+
+@dataclass(frozen=True, slots=True)
+class SecurityTest:
+    """A single security test with its pass/fail predicate resolved up front."""
+
+    name: str
+    command: str
+    description: str
+    predicate: Callable[[str, int], bool]
+
+
+@dataclass(frozen=True, slots=True)
+class TestCategory:
+    """A titled group of security tests."""
+
+    title: str
+    description: str
+    tests: tuple[SecurityTest, ...]
+
+
+# SECURITY_TESTS compiled once at import, so the test loop does no dict lookups
+# or expectation string comparisons
+TEST_CATEGORIES = tuple(
+    TestCategory(
+        title=category["title"],
+        description=category["description"],
+        tests=tuple(
+            SecurityTest(
+                name=test["name"],
+                command=test["command"],
+                description=test["description"],
+                predicate=_EXPECT_PREDICATES.get(test["expect"], _always_passes),
+            )
+            for test in category["tests"]
+        ),
     )
+    for category in SECURITY_TESTS.values()
+)
 
 
 # =============================================================================
@@ -326,44 +371,83 @@ def create_agentsh_image() -> modal.Image:
 # =============================================================================
 
 app = modal.App("agentsh-sandbox")
-image = create_agentsh_image()
+image = create_agentsh_image(AGENTSH_CONFIG_FILES)
 
 
 # =============================================================================
 # HELPER FUNCTIONS
 # =============================================================================
 
-def write_file_to_sandbox(sb: modal.Sandbox, path: str, content: str) -> None:
-    """Write a file to the sandbox filesystem."""
-    # Use heredoc to write file content safely
-    p = sb.exec("sh", "-c", f"cat > '{path}' << 'AGENTSH_EOF'\n{content}\nAGENTSH_EOF")
-    p.wait()
+# Prints OK when the daemon answers /health, STARTING while its process is up
+# but not yet serving, and DEAD once it has exited. The [a] keeps pgrep from
+# matching the probe's own command line.
+HEALTH_PROBE = (
+    "curl -sf http://127.0.0.1:18080/health > /dev/null && echo OK"
+    " || { pgrep -f '[a]gentsh server' > /dev/null && echo STARTING || echo DEAD; }"
+)
 
 
 def run_command(sb: modal.Sandbox, command: str, timeout: int = 30) -> tuple[str, str, int]:
     """Run a command in the sandbox and return stdout, stderr, exit_code."""
     p = sb.exec("bash", "-c", command, timeout=timeout)
-    p.wait()
     stdout = p.stdout.read()
     stderr = p.stderr.read()
-    exit_code = p.returncode
+    exit_code = p.wait()
     return stdout, stderr, exit_code
 
 
-def setup_agentsh(sb: modal.Sandbox, config_yaml: str, default_yaml: str, use_shim: bool = False) -> None:
+class ShellPool:
+    """Hands out idle PersistentShells to concurrent callers, starting more on demand."""
+
+    def __init__(self, sb: modal.Sandbox):
+        self._sb = sb
+        self._idle: queue.SimpleQueue[PersistentShell] = queue.SimpleQueue()
+        self._shells: list[PersistentShell] = []
+        self._lock = threading.Lock()
+
+    def run(self, command: str, timeout: float = 30, max_output: int | None = None) -> tuple[str, int]:
+        """Run a command on an idle shell and return (output, exit_code)."""
+        try:
+            shell = self._idle.get_nowait()
+        except queue.Empty:
+            shell = PersistentShell(self._sb)
+            with self._lock:
+                self._shells.append(shell)
+        try:
+            return shell.run(command, timeout=timeout, max_output=max_output)
+        finally:
+            # A shell that raised has already replaced itself, so it's reusable
+            self._idle.put(shell)
+
+    def close(self) -> None:
+        """Kill every shell the pool started, and anything still running in them, in one exec."""
+        with self._lock:
+            shells, self._shells = self._shells, []
+        kill_process_groups(self._sb, [shell.pgid for shell in shells])
+
+
+def run_security_test(shells: ShellPool, test: SecurityTest) -> tuple[str, int, bool]:
+    """Run one security test and return (output, exit_code, passed)."""
+    output, exit_code = shells.run(test.command, timeout=30, max_output=OUTPUT_LIMIT + 1)
+    output = output.strip()
+
+    # Truncate long output
+    if len(output) > OUTPUT_LIMIT:
+        output = output[:OUTPUT_LIMIT] + "..."
+
+    return output, exit_code, test.predicate(output, exit_code)
+
+
+def setup_agentsh(sb: modal.Sandbox, use_shim: bool = False) -> None:
     """Configure agentsh in the sandbox.
 
+    The config and policy files are already part of the image.
+
     Args:
         sb: Modal sandbox instance
-        config_yaml: agentsh server config content
-        default_yaml: Security policy content
         use_shim: If True, attempt to install shell shim (requires seccomp user notify).
                   If False, use network-proxy-only mode.
     """
-    print("    Writing configuration files...")
-    write_file_to_sandbox(sb, "/etc/agentsh/config.yaml", config_yaml)
-    write_file_to_sandbox(sb, "/etc/agentsh/policies/default.yaml", default_yaml)
-
     if use_shim:
         print("    Installing shell shim...")
         stdout, stderr, exit_code = run_command(
@@ -379,27 +463,40 @@ def setup_agentsh(sb: modal.Sandbox, config_yaml: str, default_yaml: str, use_sh
         print("    Skipping shell shim (seccomp user notify not available)")
         print("    Using network-proxy-only mode...")
 
-    print("    Starting agentsh daemon...")
-    # Start the daemon in background
-    sb.exec("sh", "-c", "nohup agentsh server --config /etc/agentsh/config.yaml > /var/log/agentsh/agentsh.log 2>&1 &")
-
-    # Wait for daemon to be ready
-    import time
-    for i in range(10):
-        time.sleep(1)
-        stdout, stderr, exit_code = run_command(sb, "curl -s http://127.0.0.1:18080/health 2>&1", timeout=5)
-        if exit_code == 0:
-            print(f"    agentsh daemon is running! (took {i+1}s)")
+    # A reused warm sandbox may already have a daemon; launching another would
+    # fail to bind the port, so only start one if none is running
+    stdout, _, _ = run_command(sb, HEALTH_PROBE, timeout=5)
+    status = stdout.strip()
+    if status == "OK":
+        print("    agentsh daemon is already running")
+        return
+    if status == "DEAD":
+        print("    Starting agentsh daemon...")
+        # Start the daemon in background
+        sb.exec("sh", "-c", "nohup agentsh server --config /etc/agentsh/config.yaml >> /var/log/agentsh/agentsh.log 2>&1 &")
+    else:
+        print("    agentsh daemon is already starting...")
+
+    # Wait for daemon to be ready, polling quickly at first and backing off
+    start = time.monotonic()
+    deadline = start + 10
+    delay = 0.05
+    status = ""
+    while time.monotonic() < deadline:
+        time.sleep(delay)
+        stdout, _, _ = run_command(sb, HEALTH_PROBE, timeout=5)
+        status = stdout.strip()
+        if status == "OK":
+            print(f"    agentsh daemon is running! (took {time.monotonic() - start:.2f}s)")
             return
-        # Check if process is running
-        ps_out, _, _ = run_command(sb, "pgrep -f 'agentsh server' || echo 'not running'", timeout=5)
-        if "not running" in ps_out:
+        if status == "DEAD":
             # Try to get error from log
             log_out, _, _ = run_command(sb, "cat /var/log/agentsh/agentsh.log 2>&1 | tail -20", timeout=5)
             print(f"    Daemon not running. Log:\n{log_out}")
             break
+        delay = min(delay * 1.7, 0.5)
 
-    print(f"    Warning: daemon may not be fully ready (health check: {stdout.strip() or 'no response'})")
+    print(f"    Warning: daemon may not be fully ready (health check: {status or 'no response'})")
 
 
 # =============================================================================
@@ -412,29 +509,21 @@ def main():
     print("  agentsh + Modal Sandbox Security Demo")
     print("=" * 70)
 
-    # Read configuration files
-    script_dir = Path(__file__).parent
-    config_yaml = (script_dir / "config.yaml").read_text()
-    default_yaml = (script_dir / "default.yaml").read_text()
-
     # -------------------------------------------------------------------------
     # Step 1: Create Sandbox
     # -------------------------------------------------------------------------
     print("\n[1] Creating Modal Sandbox with agentsh...")
 
-    sb = modal.Sandbox.create(
-        app=app,
-        image=image,
-        timeout=60 * 30,  # 30 minutes
-    )
+    sb = claim_sandbox(app, image, WARM_APP_NAME, WARM_SANDBOX_NAME, timeout=60 * 30)  # 30 minutes
     print(f"    Sandbox ID: {sb.object_id}")
+    shells = ShellPool(sb)
 
     try:
         # -------------------------------------------------------------------------
         # Step 2: Configure agentsh
         # -------------------------------------------------------------------------
         print("\n[2] Configuring agentsh...")
-        setup_agentsh(sb, config_yaml, default_yaml, use_shim=False)
+        setup_agentsh(sb, use_shim=False)
         print("    agentsh configured!")
 
         # -------------------------------------------------------------------------
@@ -442,56 +531,40 @@ def main():
         # -------------------------------------------------------------------------
         results = {"passed": 0, "failed": 0, "errors": 0}
 
-        for category_key, category in SECURITY_TESTS.items():
-            print(f"\n{'=' * 70}")
-            print(f"  {category['title']}")
-            print(f"  {category['description']}")
-            print("=" * 70)
-
-            for test in category["tests"]:
-                print(f"\n[TEST] {test['name']}")
-                print(f"       {test['description']}")
-                print(f"       Command: {test['command'][:60]}{'...' if len(test['command']) > 60 else ''}")
-
-                try:
-                    stdout, stderr, exit_code = run_command(sb, test["command"], timeout=30)
-                    output = (stdout + stderr).strip()
-
-                    # Truncate long output
-                    if len(output) > 200:
-                        output = output[:200] + "..."
-
-                    # Determine if test passed based on expectation
-                    if test["expect"] == "blocked":
-                        # For blocked tests, we expect non-zero exit or error message
-                        passed = (
-                            exit_code != 0
-                            or "blocked" in output.lower()
-                            or "denied" in output.lower()
-                            or "permission" in output.lower()
-                            or "400" in output
-                            or "not found" in output.lower()
-                        )
-                    elif test["expect"] == "success":
-                        passed = exit_code == 0
-                    else:
-                        passed = True
-
-                    status = "PASS" if passed else "FAIL"
-                    results["passed" if passed else "failed"] += 1
-
-                    print(f"       Output: {output if output else '(no output)'}")
-                    print(f"       Exit code: {exit_code}")
-                    print(f"       Result: [{status}]")
-
-                except TimeoutError:
-                    print("       Error: Command timed out")
-                    print("       Result: [ERROR]")
-                    results["errors"] += 1
-                except Exception as e:
-                    print(f"       Error: {e}")
-                    print("       Result: [ERROR]")
-                    results["errors"] += 1
+        with ThreadPoolExecutor(max_workers=MAX_PARALLEL_TESTS) as executor:
+            for category in TEST_CATEGORIES:
+                print(f"\n{'=' * 70}")
+                print(f"  {category.title}")
+                print(f"  {category.description}")
+                print("=" * 70)
+
+                # Tests within a category are independent, so dispatch them all
+                # at once and report the results in definition order.
+                futures = [executor.submit(run_security_test, shells, test) for test in category.tests]
+
+                for test, future in zip(category.tests, futures):
+                    print(f"\n[TEST] {test.name}")
+                    print(f"       {test.description}")
+                    print(f"       Command: {test.command[:60]}{'...' if len(test.command) > 60 else ''}")
+
+                    try:
+                        output, exit_code, passed = future.result()
+
+                        status = "PASS" if passed else "FAIL"
+                        results["passed" if passed else "failed"] += 1
+
+                        print(f"       Output: {output if output else '(no output)'}")
+                        print(f"       Exit code: {exit_code}")
+                        print(f"       Result: [{status}]")
+
+                    except TimeoutError:
+                        print("       Error: Command timed out")
+                        print("       Result: [ERROR]")
+                        results["errors"] += 1
+                    except Exception as e:
+                        print(f"       Error: {e}")
+                        print("       Result: [ERROR]")
+                        results["errors"] += 1
 
         # -------------------------------------------------------------------------
         # Summary
@@ -538,9 +611,14 @@ def main():
         # -------------------------------------------------------------------------
         # Cleanup
         # -------------------------------------------------------------------------
-        print("\n[CLEANUP] Terminating Sandbox...")
-        sb.terminate()
-        print(f"    Sandbox {sb.object_id} terminated.")
+        # A warm sandbox outlives this run, so don't leave the test shells in it
+        shells.close()
+        if WARM_SANDBOX:
+            print(f"\n[CLEANUP] Leaving Sandbox {sb.object_id} running for the next run.")
+        else:
+            print("\n[CLEANUP] Terminating Sandbox...")
+            sb.terminate()
+            print(f"    Sandbox {sb.object_id} terminated.")
 
 
 if __name__ == "__main__":
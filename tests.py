@@ -22,53 +22,46 @@ Usage:
 """
 
 import modal
+import asyncio
+import base64
 import json
+import re
+import shlex
 import time
-from pathlib import Path
+from agentsh_common import AGENTSH_CONFIG_FILES, AGENTSH_TAG, PersistentShell, create_agentsh_image
 
 # =============================================================================
 # CONFIGURATION
 # =============================================================================
 
-AGENTSH_REPO = "canyonroad/agentsh"
-AGENTSH_TAG = "v0.8.10"
-DEB_ARCH = "amd64"
+# Sandbox command that starts the agentsh daemon when the sandbox boots
+START_SCRIPT_PATH = "/usr/local/bin/agentsh-start.sh"
 
 
 # =============================================================================
-# MODAL IMAGE DEFINITION
+# TEST DEFINITIONS
 # =============================================================================
 
-def create_agentsh_image() -> modal.Image:
-    """Create a Modal image with agentsh installed."""
-    version = AGENTSH_TAG.lstrip("v")
-    deb_name = f"agentsh_{version}_linux_{DEB_ARCH}.deb"
-    deb_url = f"https://github.com/{AGENTSH_REPO}/releases/download/{AGENTSH_TAG}/{deb_name}"
-
-    return (
-        modal.Image.debian_slim(python_version="3.11")
-        .apt_install(
-            "ca-certificates",
-            "curl",
-            "bash",
-            "git",
-            "sudo",
-            "libseccomp2",
-            "netcat-openbsd",
-            "openssh-client",
-        )
-        .run_commands(
-            f"curl -fsSL -L '{deb_url}' -o /tmp/agentsh.deb",
-            "dpkg -i /tmp/agentsh.deb",
-            "rm -f /tmp/agentsh.deb",
-            "agentsh --version",
-            "mkdir -p /etc/agentsh/policies /var/lib/agentsh/quarantine /var/lib/agentsh/sessions /var/log/agentsh",
-            "chmod 777 /etc/agentsh /etc/agentsh/policies",
-            "chmod 777 /var/lib/agentsh /var/lib/agentsh/quarantine /var/lib/agentsh/sessions",
-            "chmod 777 /var/log/agentsh",
-        )
-        .env({"AGENTSH_SERVER": "http://127.0.0.1:18080"})
-    )
+API_TESTS = [
+    ("Health endpoint", "/health"),
+    ("Ready endpoint", "/ready"),
+    ("Metrics endpoint", "/metrics"),
+    ("Policy list", "/api/v1/policies"),
+    ("Server info", "/api/v1/info"),
+]
+
+ISOLATION_TESTS = [
+    ("AWS metadata blocked", "curl -s --connect-timeout 2 http://169.254.169.254/", "blocked"),
+    ("No docker socket", "ls -la /var/run/docker.sock", "blocked"),
+    ("No host filesystem", "ls /host", "blocked"),
+    ("Container runs as root", "whoami", "success"),
+    ("Git available", "git --version", "success"),
+    ("Python available", "python3 --version", "success"),
+]
+
+# Commands in the generated suite script
+SUITE_COMMANDS = [cmd for _, cmd, _ in ISOLATION_TESTS]
+SUITE_PATH = "/tmp/agentsh_suite.sh"
 
 
 # =============================================================================
@@ -76,74 +69,253 @@ def create_agentsh_image() -> modal.Image:
 # =============================================================================
 
 app = modal.App("agentsh-tests")
-image = create_agentsh_image()
+image = create_agentsh_image({**AGENTSH_CONFIG_FILES, "agentsh-start.sh": START_SCRIPT_PATH})
 
 
 # =============================================================================
 # HELPER FUNCTIONS
 # =============================================================================
 
-def write_file_to_sandbox(sb: modal.Sandbox, path: str, content: str) -> None:
-    """Write a file to the sandbox filesystem."""
-    p = sb.exec("sh", "-c", f"cat > '{path}' << 'AGENTSH_EOF'\n{content}\nAGENTSH_EOF")
-    p.wait()
+# One path's block in _API_PROBE_SCRIPT output: index, body, status
+_BATCH_RESULT_RE = re.compile(r"===AGENTSH_TEST:(\d+)===\n(.*?)===AGENTSH_EXIT:\1:(\d+)===", re.DOTALL)
+
+# One record in suite script output: index, exit code, base64 output
+_SUITE_RECORD_RE = re.compile(r"^###(\d+)\t(\d+)\t(\S*)$", re.MULTILINE)
+
+# GET /health using only bash builtins (/dev/tcp, printf, read), so a probe
+# run in the persistent shell forks no processes. Prints the raw HTTP
+# response, or nothing if the daemon isn't listening yet.
+_HEALTH_PROBE = (
+    "{ exec 3<>/dev/tcp/127.0.0.1/18080; } 2>/dev/null"
+    " && printf 'GET /health HTTP/1.0\\r\\nHost: localhost\\r\\n\\r\\n' >&3"
+    ' && while IFS= read -r -t 1 line <&3 || [ -n "$line" ]; do printf \'%s\\n\' "$line"; done;'
+    " exec 3<&-"
+)
+
+# Creates a session and fetches its info in one round-trip, printing each
+# step's output after a marker. Runs in a subshell so `set -e` can't take
+# down the persistent shell; python3 stands in for jq, which isn't installed.
+_SESSION_SCRIPT = """\
+( set -e
+  echo '===AGENTSH_CREATE==='
+  C=$(agentsh session create --workspace /root --json)
+  printf '%s\\n' "$C"
+  ID=$(printf %s "$C" | python3 -c 'import json, sys; print(json.load(sys.stdin)["id"])')
+  echo '===AGENTSH_INFO==='
+  agentsh session info "$ID" --json )"""
+
+# The session object in `agentsh session create --json` output
+_SESSION_JSON_RE = re.compile(r'\{[^{}]*"id"[^{}]*\}')
+
+# Run inside the sandbox with API paths as arguments: GETs each one over a
+# single keep-alive connection and frames each result for _BATCH_RESULT_RE
+_API_PROBE_SCRIPT = """\
+import http.client, sys
+conn = http.client.HTTPConnection("127.0.0.1", 18080, timeout=5)
+for i, path in enumerate(sys.argv[1:]):
+    try:
+        conn.request("GET", path)
+        body, code = conn.getresponse().read()[:100].decode(errors="replace"), 0
+    except (OSError, http.client.HTTPException) as e:
+        conn.close()
+        body, code = str(e), 1
+    print(f"===AGENTSH_TEST:{i}===\\n{body}===AGENTSH_EXIT:{i}:{code}===")
+"""
+
 
+def build_suite_script(commands: list[str]) -> str:
+    """Render commands into a bash script that reports each one as a record.
 
-def run_command(sb: modal.Sandbox, command: str, timeout: int = 30) -> tuple[str, str, int]:
-    """Run a command in the sandbox and return stdout, stderr, exit_code."""
-    try:
-        p = sb.exec("bash", "-c", command, timeout=timeout)
-        p.wait()
-        stdout = p.stdout.read() if p.stdout else ""
-        stderr = p.stderr.read() if p.stderr else ""
+    Records are tab-separated `###<index> <exit code> <base64 output>` lines.
+    """
+    lines = [
+        "run() {",
+        '    out=$(eval "$2" 2>&1 < /dev/null)',
+        "    ec=$?",
+        '    printf \'###%s\\t%d\\t%s\\n\' "$1" "$ec" "$(printf %s "${out:0:200}" | base64 -w0)"',
+        "}",
+    ]
+    lines += [f"run {i} {shlex.quote(command)}" for i, command in enumerate(commands)]
+    return "\n".join(lines) + "\n"
+
+
+def write_files_to_sandbox(sb: modal.Sandbox, files: dict[str, str]) -> None:
+    """Write several files to the sandbox filesystem in one exec.
+
+    Raises RuntimeError if the write fails, so nothing runs a missing or
+    partial file.
+    """
+    # Contents travel base64-encoded, so the shell never has to scan or
+    # quote them and any bytes are safe
+    commands = []
+    for path, content in files.items():
+        encoded = base64.b64encode(content.encode()).decode()
+        commands.append(f"mkdir -p \"$(dirname '{path}')\" && printf %s '{encoded}' | base64 -d > '{path}'")
+    script = " && ".join(commands)
+    p = sb.exec("sh", "-c", script)
+    if p.wait() != 0:
+        raise RuntimeError(f"Writing {', '.join(files)} failed: {p.stderr.read().strip()}")
+
+
+async def run_command(sb: modal.Sandbox, command: str, timeout: int = 30) -> tuple[str, str, int]:
+    """Run a command in the sandbox and return stdout, stderr, exit_code.
+
+    The whole call is bounded by the timeout (plus a short grace period for
+    the sandbox to kill the command), so a stalled stream returns -1 instead
+    of hanging.
+    """
+
+    async def communicate() -> tuple[str, str, int]:
+        p = await sb.exec.aio("bash", "-c", command, timeout=timeout)
+        # Drain both streams concurrently while the command runs, so a chatty
+        # stream can't fill its pipe and stall the process
+        stdout, stderr = await asyncio.gather(p.stdout.read.aio(), p.stderr.read.aio())
+        await p.wait.aio()
         exit_code = p.returncode if p.returncode is not None else -1
         return stdout, stderr, exit_code
+
+    try:
+        return await asyncio.wait_for(communicate(), timeout + 5)
+    except asyncio.TimeoutError:
+        return "", f"command did not finish within {timeout}s", -1
     except Exception as e:
         return "", str(e), -1
 
 
-def setup_agentsh(sb: modal.Sandbox, config_yaml: str, default_yaml: str) -> str:
-    """Configure agentsh and start the daemon.
+def run_in_shell(shell: PersistentShell, command: str, timeout: float = 30) -> tuple[str, int]:
+    """Run a command on the persistent shell, returning (error message, -1)
+    instead of raising if it times out or the shell exits.
+    """
+    try:
+        return shell.run(command, timeout=timeout)
+    except (TimeoutError, RuntimeError) as e:
+        return str(e), -1
+
+
+def _parse_batch(stdout: str, count: int) -> list[tuple[str, int]]:
+    """Extract (output, exit_code) per command from framed batch output."""
+    results = [("", -1)] * count
+    for match in _BATCH_RESULT_RE.finditer(stdout):
+        results[int(match.group(1))] = (match.group(2), int(match.group(3)))
+    return results
+
+
+async def run_suite(sb: modal.Sandbox, timeout: int = 60) -> list[tuple[str, int] | None]:
+    """Run the suite script written by setup_agentsh() in one sandbox exec.
+
+    Returns (output, exit_code) per SUITE_COMMANDS entry, with stdout and
+    stderr combined and cut to 200 characters. Commands that didn't report
+    back (e.g. on timeout) get None, so they can't pass as "blocked".
+    """
+    stdout, _, _ = await run_command(sb, f"bash {SUITE_PATH}", timeout=timeout)
+
+    results: list[tuple[str, int] | None] = [None] * len(SUITE_COMMANDS)
+    for match in _SUITE_RECORD_RE.finditer(stdout):
+        output = base64.b64decode(match.group(3)).decode(errors="replace")
+        results[int(match.group(1))] = (output, int(match.group(2)))
+    return results
+
+
+async def fetch_api_paths(sb: modal.Sandbox, paths: list[str]) -> list[tuple[str, int]]:
+    """GET agentsh API paths from inside the sandbox over one HTTP connection.
+
+    Returns (body, status) per path, with bodies cut to 100 characters and
+    status 0 on success.
+    """
+    command = shlex.join(["python3", "-c", _API_PROBE_SCRIPT, *paths])
+    stdout, _, _ = await run_command(sb, command)
+    return _parse_batch(stdout, len(paths))
+
+
+def setup_agentsh(sb: modal.Sandbox, shell: PersistentShell) -> tuple[str, int, bool]:
+    """Wait for the agentsh daemon and create a session.
 
-    Returns the session ID.
+    The daemon is started by the sandbox entrypoint. Returns the session ID,
+    the exit code of `agentsh session info` for it (-1 if it didn't run), and
+    whether the daemon log reports a seccomp limitation.
     """
-    print("    Writing configuration files...")
-    write_file_to_sandbox(sb, "/etc/agentsh/config.yaml", config_yaml)
-    write_file_to_sandbox(sb, "/etc/agentsh/policies/default.yaml", default_yaml)
-
-    print("    Starting agentsh daemon...")
-    sb.exec("sh", "-c", "agentsh server --config /etc/agentsh/config.yaml > /var/log/agentsh/agentsh.log 2>&1 &")
-
-    # Wait for daemon to be ready
-    for i in range(20):
-        time.sleep(1)
-        stdout, stderr, exit_code = run_command(sb, "curl -s http://127.0.0.1:18080/health 2>&1", timeout=5)
-        output = (stdout + stderr).strip()
-        if exit_code == 0 and output:
-            print(f"    agentsh daemon health: {output[:50]} (took {i+1}s)")
+    print("    Writing test suite script...")
+    write_files_to_sandbox(sb, {SUITE_PATH: build_suite_script(SUITE_COMMANDS)})
+
+    print("    Waiting for agentsh daemon...")
+    # Wait for daemon to be ready, polling fast at first and backing off
+    start = time.monotonic()
+    deadline = start + 20
+    delay = 0.025
+    while time.monotonic() < deadline:
+        time.sleep(delay)
+        output, _ = run_in_shell(shell, _HEALTH_PROBE, timeout=5)
+        head, _, body = output.replace("\r", "").partition("\n\n")
+        if head.split(" ", 2)[1:2] == ["200"]:
+            print(f"    agentsh daemon health: {body.strip()[:50]} (took {time.monotonic() - start:.2f}s)")
             break
+        delay = min(delay * 1.5, 1.0)
     else:
-        log_out, log_err, _ = run_command(sb, "cat /var/log/agentsh/agentsh.log 2>&1 | tail -30", timeout=5)
-        print(f"    Warning: daemon may not be ready. Log:\n{(log_out + log_err)[:500]}")
+        log_out, _ = run_in_shell(shell, "tail -n 30 /var/log/agentsh/agentsh.log", timeout=5)
+        print(f"    Warning: daemon may not be ready. Log:\n{log_out[:500]}")
 
-    # Create a session
+    # agentsh exec is expected to fail when the daemon already logged that
+    # seccomp is unusable, so main() can give that test a short timeout
+    _, grep_code = run_in_shell(shell, "grep -qi seccomp /var/log/agentsh/agentsh.log", timeout=5)
+    seccomp_limited = grep_code == 0
+
+    # Create a session and check its info
     print("    Creating agentsh session...")
-    stdout, stderr, exit_code = run_command(sb, "agentsh session create --workspace /root --json 2>&1", timeout=30)
-    output = (stdout + stderr).strip()
+    output, exit_code = run_in_shell(shell, _SESSION_SCRIPT, timeout=30)
+    create_part, info_marker, _ = output.partition("===AGENTSH_INFO===\n")
+    info_exit_code = exit_code if info_marker else -1
+    output = create_part.partition("===AGENTSH_CREATE===\n")[2].strip()
 
+    # --json output is normally clean JSON; only scan for the session object
+    # when something else (e.g. a warning) got mixed in
     try:
-        import re
-        json_match = re.search(r'\{[^{}]*"id"[^{}]*\}', output)
-        if json_match:
-            session_data = json.loads(json_match.group())
-        else:
-            session_data = json.loads(output)
-        session_id = session_data.get("id", "")
-        print(f"    Session ID: {session_id}")
-        return session_id
-    except json.JSONDecodeError as e:
-        print(f"    Failed to parse session response: {e}")
-        return ""
+        session_data = json.loads(output)
+    except json.JSONDecodeError:
+        json_match = _SESSION_JSON_RE.search(output)
+        try:
+            session_data = json.loads(json_match.group()) if json_match else {}
+        except json.JSONDecodeError:
+            session_data = {}
+    session_id = session_data.get("id", "") if isinstance(session_data, dict) else ""
+    if not session_id:
+        print(f"    Failed to parse session response: {output[:200]}")
+        return "", info_exit_code, seccomp_limited
+    print(f"    Session ID: {session_id}")
+    return session_id, info_exit_code, seccomp_limited
+
+
+# Body of the final summary; main() fills in the counts and agentsh tag
+_SUMMARY_TEMPLATE = """
+    Tests passed: {passed}
+    Tests failed: {failed}
+
+    ═══════════════════════════════════════════════════════════════════
+    WHAT WORKS ON MODAL
+    ═══════════════════════════════════════════════════════════════════
+      ✓ agentsh daemon ({tag})
+      ✓ Health/Ready/Metrics endpoints
+      ✓ Session creation and management
+      ✓ Policy configuration loaded
+      ✓ API endpoints accessible
+      ✓ Modal native container isolation
+
+    ═══════════════════════════════════════════════════════════════════
+    MODAL NATIVE PROTECTION
+    ═══════════════════════════════════════════════════════════════════
+      ✓ Cloud metadata blocked (169.254.169.254)
+      ✓ No Docker socket access
+      ✓ No host filesystem access
+      ✓ Container isolation
+
+    ═══════════════════════════════════════════════════════════════════
+    LIMITATIONS ON MODAL
+    ═══════════════════════════════════════════════════════════════════
+      ⚠️  agentsh exec not available (seccomp_user_notify required)
+      ⚠️  Shell shim not available (same limitation)
+
+    For full agentsh functionality including command interception,
+    use a platform with seccomp_user_notify support (e.g., E2B).
+"""
 
 
 # =============================================================================
@@ -151,17 +323,17 @@ def setup_agentsh(sb: modal.Sandbox, config_yaml: str, default_yaml: str) -> str
 # =============================================================================
 
 @app.local_entrypoint()
-def main():
+async def main():
     print("=" * 70)
     print("  agentsh + Modal Sandbox Demo")
     print("=" * 70)
 
-    script_dir = Path(__file__).parent
-    config_yaml = (script_dir / "config.yaml").read_text()
-    default_yaml = (script_dir / "default.yaml").read_text()
-
     print("\n[1] Creating Modal Sandbox with agentsh...")
-    sb = modal.Sandbox.create(
+    # The start script launches the daemon and then idles, so the daemon
+    # boots in parallel with the rest of the sandbox bring-up
+    sb = await modal.Sandbox.create.aio(
+        "sh",
+        START_SCRIPT_PATH,
         app=app,
         image=image,
         timeout=60 * 30,
@@ -172,7 +344,24 @@ def main():
 
     try:
         print("\n[2] Configuring agentsh...")
-        session_id = setup_agentsh(sb, config_yaml, default_yaml)
+        # Setup is sequential and uses the blocking persistent shell, so keep
+        # it off the event loop
+        shell = await asyncio.to_thread(PersistentShell, sb)
+        session_id, info_exit_code, seccomp_limited = await asyncio.to_thread(setup_agentsh, sb, shell)
+
+        exec_check = []
+        if session_id:
+            json_payload = json.dumps({"command": "/bin/echo", "args": ["test"]})
+            exec_command = f"agentsh exec {session_id} --json '{json_payload}'"
+            exec_check = [run_command(sb, exec_command, timeout=3 if seccomp_limited else 30)]
+
+        # The test groups are independent, so run them concurrently and report
+        # them in order once all are back
+        api_results, isolation_results, *exec_result = await asyncio.gather(
+            fetch_api_paths(sb, [path for _, path in API_TESTS]),
+            run_suite(sb),
+            *exec_check,
+        )
 
         # =====================================================================
         # DAEMON & API TESTS
@@ -181,17 +370,8 @@ def main():
         print("  DAEMON & API TESTS")
         print("=" * 70)
 
-        api_tests = [
-            ("Health endpoint", "curl -s http://127.0.0.1:18080/health"),
-            ("Ready endpoint", "curl -s http://127.0.0.1:18080/ready"),
-            ("Metrics endpoint", "curl -s http://127.0.0.1:18080/metrics | head -5"),
-            ("Policy list", "curl -s http://127.0.0.1:18080/api/v1/policies | head -c 100"),
-            ("Server info", "curl -s http://127.0.0.1:18080/api/v1/info | head -c 100"),
-        ]
-
-        for name, cmd in api_tests:
-            stdout, stderr, exit_code = run_command(sb, cmd)
-            output = (stdout + stderr).strip()
+        for (name, _), (output, exit_code) in zip(API_TESTS, api_results):
+            output = output.strip()
             if exit_code == 0 and output:
                 results["passed"] += 1
                 print(f"    ✓ {name}: PASS")
@@ -213,8 +393,7 @@ def main():
             print(f"    ✓ Session created: {session_id[:40]}...")
 
             # Get session info
-            stdout, stderr, exit_code = run_command(sb, f"agentsh session info {session_id} --json 2>&1 | head -c 200")
-            if exit_code == 0:
+            if info_exit_code == 0:
                 results["passed"] += 1
                 print("    ✓ Session info retrieved")
             else:
@@ -231,18 +410,13 @@ def main():
         print("  MODAL NATIVE ISOLATION TESTS")
         print("=" * 70)
 
-        isolation_tests = [
-            ("AWS metadata blocked", "curl -s --connect-timeout 2 http://169.254.169.254/", "blocked"),
-            ("No docker socket", "ls -la /var/run/docker.sock 2>&1", "blocked"),
-            ("No host filesystem", "ls /host 2>&1", "blocked"),
-            ("Container runs as root", "whoami", "success"),
-            ("Git available", "git --version", "success"),
-            ("Python available", "python3 --version", "success"),
-        ]
-
-        for name, cmd, expect in isolation_tests:
-            stdout, stderr, exit_code = run_command(sb, cmd, timeout=10)
-            output = (stdout + stderr).strip()
+        for (name, _, expect), result in zip(ISOLATION_TESTS, isolation_results):
+            if result is None:
+                results["failed"] += 1
+                print(f"    ✗ {name} (no result from test suite)")
+                continue
+            output, exit_code = result
+            output = output.strip()
 
             if expect == "blocked":
                 passed = exit_code != 0 or "denied" in output.lower() or "not found" in output.lower() or not output
@@ -270,8 +444,7 @@ def main():
         print("    Testing exec to show limitation...")
 
         if session_id:
-            json_payload = json.dumps({"command": "/bin/echo", "args": ["test"]})
-            stdout, stderr, exit_code = run_command(sb, f"agentsh exec {session_id} --json '{json_payload}' 2>&1")
+            stdout, stderr, exit_code = exec_result[0]
             output = (stdout + stderr).strip()
 
             if "seccomp" in output.lower() or exit_code != 0:
@@ -286,41 +459,11 @@ def main():
         print("\n" + "=" * 70)
         print("  SUMMARY")
         print("=" * 70)
-        print(f"""
-    Tests passed: {results['passed']}
-    Tests failed: {results['failed']}
-
-    ═══════════════════════════════════════════════════════════════════
-    WHAT WORKS ON MODAL
-    ═══════════════════════════════════════════════════════════════════
-      ✓ agentsh daemon ({AGENTSH_TAG})
-      ✓ Health/Ready/Metrics endpoints
-      ✓ Session creation and management
-      ✓ Policy configuration loaded
-      ✓ API endpoints accessible
-      ✓ Modal native container isolation
-
-    ═══════════════════════════════════════════════════════════════════
-    MODAL NATIVE PROTECTION
-    ═══════════════════════════════════════════════════════════════════
-      ✓ Cloud metadata blocked (169.254.169.254)
-      ✓ No Docker socket access
-      ✓ No host filesystem access
-      ✓ Container isolation
-
-    ═══════════════════════════════════════════════════════════════════
-    LIMITATIONS ON MODAL
-    ═══════════════════════════════════════════════════════════════════
-      ⚠️  agentsh exec not available (seccomp_user_notify required)
-      ⚠️  Shell shim not available (same limitation)
-
-    For full agentsh functionality including command interception,
-    use a platform with seccomp_user_notify support (e.g., E2B).
-""")
+        print(_SUMMARY_TEMPLATE.format(passed=results["passed"], failed=results["failed"], tag=AGENTSH_TAG))
 
     finally:
         print("\n[CLEANUP] Terminating Sandbox...")
-        sb.terminate()
+        await sb.terminate.aio()
         print("    Sandbox terminated.")
 
 